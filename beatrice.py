@@ -1,11 +1,13 @@
-import argparse
 import asyncio
-from datetime import datetime
+import re
+import time
+from dataclasses import dataclass
 
 from textual import events, validation
 from textual.app import App, ComposeResult
 from textual.binding import Binding
 from textual.containers import Container, VerticalScroll
+from textual.widget import Widget
 from textual.widgets import Input, Label, ListItem, ListView
 
 # import client class
@@ -15,42 +17,126 @@ from client import Client
 SERVER_HOST = "localhost"
 SERVER_PORT = 55556
 MAX_NICKNAME_LENGTH = 20
+MESSAGE_WINDOW_SIZE = 50  # Max number of chat log rows kept mounted at once
+HYDRATE_BATCH_SIZE = 25  # Rows re-mounted each time the user scrolls to the top
+ESTIMATED_ROW_HEIGHT = 4  # Rough height of a row, used to keep the scroll position stable
+SCROLL_DEBOUNCE = 0.05  # Scroll the chat log to the bottom at most 20 times a second
+ME_PREFIX = "Me: \n"  # Prefix shown above our own messages
+ACTIVITY_RESOLUTION = 1.0  # Seconds between inactivity_timer updates
+MAX_BATCH = 64  # Max number of events handled in one pass of process_events
+ROSTER_EVENTS = frozenset(("join_packet", "leave_packet", "dir"))  # Events that change who is online
+QUIT_COMMANDS = frozenset(("exit", "quit", ":q"))  # Typed into the message input to leave
+SHUTDOWN_TIMEOUT = 2.0  # Seconds the sender gets to flush queued messages on exit
+
+# CSS classes for each kind of chat log row, built once instead of per row
+BUBBLE_CLASSES = "bubble"
+MESSAGE_ROW_CLASSES = {
+    "received_dm": "message_row received",
+    "received": "dm_message_row received",
+    "sent": "message_row sent",
+}
+SYSTEM_ROW_CLASSES = {  # kind: (label classes, row classes)
+    "join": ("join_message", "join_packet"),
+    "dir": ("dir_message", "dir_packet"),
+    "leave": ("leave_message", "leave_packet"),
+}
+
+
+# Only needed when run as a script, so argparse isn't imported by anything that
+# just imports Beatrice
+def _parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="Beatrice",
+        description="Start a Beatrice client",
+        add_help=False,
+        conflict_handler="resolve",
+    )
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="IP address of the server  (default: '127.0.0.1')",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=55556,
+        help="Port number of the server (default: 55556)",
+    )
+
+    parser.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        default=argparse.SUPPRESS,
+        help="Show this help message.",
+    )
+
+    return parser.parse_args()
+
+
+# Login screen art, built once at import rather than on every compose
+LOGIN_TITLE = """
+█████▄ ██████ ▄████▄ ██████ █████▄  ██ ▄█████ ██████
+██▄▄██ ██▄▄   ██▄▄██   ██   ██▄▄██▄ ██ ██     ██▄▄
+██▄▄█▀ ██▄▄▄▄ ██  ██   ██   ██   ██ ██ ▀█████ ██▄▄▄▄
+----------------------------------------------------
+"""
+ASCII_DOG = """
+    ⠀⠀⠀⠀⠀⠀⢀⣀⣀⣀⣀⣀⣀⣀⡀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀
+    ⠀⠀⢀⡤⠞⠋⠉⠀⠀⠀⠀⠀⠀⠀⠉⠙⠳⢄⡀⠀⠀⠀⠀⠀⠀⠀⠀⠀
+    ⠀⣠⠋⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠱⡆⠀⠀⠀⠀⠀⠀⠀⠀
+    ⢠⠇⠀⢰⠆⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠰⡄⠀⢸⡀⠀⠀⠀⠀⠀⠀⠀
+    ⢸⠀⠀⢸⠀⠀⢰⣶⡀⠀⠀⠀⢠⣶⡀⠀⠀⡇⠀⢸⠂⠀⠀⠀⠀⠀⠀⠀
+    ⠈⢧⣀⢸⡄⠀⠀⠉⠀⠀⠀⠀⠀⠉⠀⠀⢠⡇⣠⡞⠁⠀⠀⠀⠀⠀⠀⠀
+    ⠀⠀⠉⠙⣇⠀ ⠀⠀⢶⣶⣶⠀ ⠀⠀⣾⠉⠁⠀⠀⠀⠀⠀⠀⠀⠀⠀
+    ⠀⠀⠀⠀⠘⢦⡀⠀⠀⠀⢸⠀⠀⠀⠀⢀⣼⡁⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀
+    ⠀⠀⠀⠀⢠⠞⠓⠤⣤⣀⣀⣠⣤⠴⠚⠉⠑⠲⢤⡀⠀⠀⠀⠀⠀⠀⠀⠀
+    ⠀⠀⠀⠀⢸⠀⠀⠀⠀⠀⠀       ⠀⠈⠳⣄⠀⠀⠀⠀⠀⠀
+    ⠀⠀⠀⠀⢸⠀⠰⡇⠀⠈⠁⠀⠈⡧⠀⠀⠀⠀⠀⠀⠀⠈⢦⠀⠀⢠⠖⡆
+    ⠀⠀⠀⠀⢸⠀⠀⠑⢦⡀⠀⣠⠞⠁⠀⢸⠀⠀⠀⠀⠀⠀⠈⣷⠞⠋⢠⠇
+    ⠀⠀⠀⠀⢸⠀⠀⠀⠀⠙⡞⠁⠀⠀⠀⢸⠀⠀⠀⠀⠀⠀⠀⢹⢀⡴⠋⠀
+    ⠀⠀⠀⠀⢸⠀⠀⠀⠀⠀⡇⠀⠀⠀⠀⢸⠀⠀⠀⠀⠀⠀⠀⡞⠉⠀⠀⠀
+    ⠀⠀⠀⠀⢸⡀⠀⠀⠀⢠⣧⠀⠀⠀⠀⣸⡀⠀⠀⠀⠀⣠⠞⠁⠀⠀⠀⠀
+    ⠀⠀⠀⠀⠈⠳⠦⠤⠴⠛⠈⠓⠤⠤⠞⠁⠉⠛⠒⠚⠋⠁⠀⠀⠀⠀⠀⠀
+            """
+
+
+# Nickname must be between 3 and 20 characters long, letters and numbers only.
+# Compiled once, Textual's Regex validator runs it without a Python-level call
+NICKNAME_RE = re.compile(rf"[A-Za-z0-9]{{3,{MAX_NICKNAME_LENGTH}}}")
+
 
+@dataclass
+class MessageData:
+    """Lightweight record of a single chat log row"""
 
-parser = argparse.ArgumentParser(
-    prog="Beatrice",
-    description="Start a Beatrice client",
-    add_help=False,
-    conflict_handler="resolve",
-)
+    kind: str  # "received", "received_dm", "sent", "join", "dir" or "leave"
+    content: str
+    prefix: str = ""
+    ts: str = ""
 
-parser.add_argument(
-    "--host",
-    type=str,
-    default="127.0.0.1",
-    help="IP address of the server  (default: '127.0.0.1')",
-)
-parser.add_argument(
-    "--port",
-    type=int,
-    default=55556,
-    help="Port number of the server (default: 55556)",
-)
 
-parser.add_argument(
-    "-h",
-    "--help",
-    action="help",
-    default=argparse.SUPPRESS,
-    help="Show this help message.",
-)
+class MessageStore:
+    """
+    Keeps every chat log row as a MessageData, and tracks which of them
+    currently have a widget mounted in the chat log.
+    """
 
-args = parser.parse_args()
+    def __init__(self) -> None:
+        self.messages: list[MessageData] = []
+        self.mounted: dict[int, Widget] = {}
 
+    def append(self, data: MessageData) -> int:
+        self.messages.append(data)
+        return len(self.messages) - 1
 
-# Nickname must be between 3 and 20 characters long
-def validate_nickname(value: str) -> bool:
-    return 3 <= len(value) <= MAX_NICKNAME_LENGTH and value.isalnum()
+    @property
+    def first_mounted(self) -> int | None:
+        return min(self.mounted) if self.mounted else None
 
 
 class TimestampLabel(Label):
@@ -58,18 +144,33 @@ class TimestampLabel(Label):
 
     last_date = None  # Class variable
 
-    def __init__(self, message: str, prefix: str = "", *args, **kwargs):
-        timestamp = self.get_timestamp()
-        full_message = (
-            f"[{timestamp}] {prefix}{message}" if prefix else f"[{timestamp}] {message}"
+    # The formatted date and time only change once a minute, so cache them.
+    # (minute epoch, date, time) live in one tuple so a single assignment
+    # swaps all three, and a reader can never see a half-updated cache.
+    _cache: tuple[int, str, str] = (-1, "", "")
+
+    def __init__(
+        self, message: str, prefix: str = "", *args, timestamp: str = "", **kwargs
+    ):
+        # prefix is "" when unused, so one f-string covers both cases
+        super().__init__(
+            f"[{timestamp or self.get_timestamp()}] {prefix}{message}", *args, **kwargs
         )
-        super().__init__(full_message, *args, **kwargs)
 
     @classmethod
     def get_timestamp(cls):
-        now = datetime.now()
-        current_date = now.strftime("%d/%m/%y")
-        current_time = now.strftime("%H:%M")
+        now = time.time()
+        minute = int(now) // 60
+
+        cached_minute, current_date, current_time = cls._cache
+
+        # Only re-format when the minute rolls over
+        if minute != cached_minute:
+            # One strftime call, then split "dd/mm/yy HH:MM" at the space
+            current_date, current_time = time.strftime(
+                "%d/%m/%y %H:%M", time.localtime(now)
+            ).split(" ")
+            cls._cache = (minute, current_date, current_time)
 
         if cls.last_date is None or cls.last_date != current_date:
             cls.last_date = current_date
@@ -86,16 +187,17 @@ class Beatrice(App):
     # Set bindings
     BINDINGS = [("ctrl+c", "quit", "Quit"), ("ctrl+q", "noop")]
 
+    def __init__(self, host: str = "127.0.0.1", port: int = SERVER_PORT) -> None:
+        super().__init__()
+        # Server the client connects to once a nickname is entered
+        self.server_host: str = host
+        self.server_port: int = port
+
     def compose(self) -> ComposeResult:
 
         yield Container(
             Label(
-                """
-█████▄ ██████ ▄████▄ ██████ █████▄  ██ ▄█████ ██████
-██▄▄██ ██▄▄   ██▄▄██   ██   ██▄▄██▄ ██ ██     ██▄▄
-██▄▄█▀ ██▄▄▄▄ ██  ██   ██   ██   ██ ██ ▀█████ ██▄▄▄▄
-----------------------------------------------------
-""",
+                LOGIN_TITLE,
                 id="login_title_text",
             ),
             id="login_title_container",
@@ -106,9 +208,9 @@ class Beatrice(App):
             Input(
                 placeholder="Enter your nickname...",
                 validators=[
-                    validation.Function(
-                        validate_nickname,
-                        f"Nickname must be between 3 and {MAX_NICKNAME_LENGTH} characters long and contain only letters or numbers.",
+                    validation.Regex(
+                        NICKNAME_RE,
+                        failure_description=f"Nickname must be between 3 and {MAX_NICKNAME_LENGTH} characters long and contain only letters or numbers.",
                     )
                 ],
                 id="nickname_input",
@@ -118,24 +220,7 @@ class Beatrice(App):
         )
 
         yield Container(
-            Label("""
-    ⠀⠀⠀⠀⠀⠀⢀⣀⣀⣀⣀⣀⣀⣀⡀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀
-    ⠀⠀⢀⡤⠞⠋⠉⠀⠀⠀⠀⠀⠀⠀⠉⠙⠳⢄⡀⠀⠀⠀⠀⠀⠀⠀⠀⠀
-    ⠀⣠⠋⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠱⡆⠀⠀⠀⠀⠀⠀⠀⠀
-    ⢠⠇⠀⢰⠆⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠰⡄⠀⢸⡀⠀⠀⠀⠀⠀⠀⠀
-    ⢸⠀⠀⢸⠀⠀⢰⣶⡀⠀⠀⠀⢠⣶⡀⠀⠀⡇⠀⢸⠂⠀⠀⠀⠀⠀⠀⠀
-    ⠈⢧⣀⢸⡄⠀⠀⠉⠀⠀⠀⠀⠀⠉⠀⠀⢠⡇⣠⡞⠁⠀⠀⠀⠀⠀⠀⠀
-    ⠀⠀⠉⠙⣇⠀ ⠀⠀⢶⣶⣶⠀ ⠀⠀⣾⠉⠁⠀⠀⠀⠀⠀⠀⠀⠀⠀
-    ⠀⠀⠀⠀⠘⢦⡀⠀⠀⠀⢸⠀⠀⠀⠀⢀⣼⡁⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀
-    ⠀⠀⠀⠀⢠⠞⠓⠤⣤⣀⣀⣠⣤⠴⠚⠉⠑⠲⢤⡀⠀⠀⠀⠀⠀⠀⠀⠀
-    ⠀⠀⠀⠀⢸⠀⠀⠀⠀⠀⠀       ⠀⠈⠳⣄⠀⠀⠀⠀⠀⠀
-    ⠀⠀⠀⠀⢸⠀⠰⡇⠀⠈⠁⠀⠈⡧⠀⠀⠀⠀⠀⠀⠀⠈⢦⠀⠀⢠⠖⡆
-    ⠀⠀⠀⠀⢸⠀⠀⠑⢦⡀⠀⣠⠞⠁⠀⢸⠀⠀⠀⠀⠀⠀⠈⣷⠞⠋⢠⠇
-    ⠀⠀⠀⠀⢸⠀⠀⠀⠀⠙⡞⠁⠀⠀⠀⢸⠀⠀⠀⠀⠀⠀⠀⢹⢀⡴⠋⠀
-    ⠀⠀⠀⠀⢸⠀⠀⠀⠀⠀⡇⠀⠀⠀⠀⢸⠀⠀⠀⠀⠀⠀⠀⡞⠉⠀⠀⠀
-    ⠀⠀⠀⠀⢸⡀⠀⠀⠀⢠⣧⠀⠀⠀⠀⣸⡀⠀⠀⠀⠀⣠⠞⠁⠀⠀⠀⠀
-    ⠀⠀⠀⠀⠈⠳⠦⠤⠴⠛⠈⠓⠤⠤⠞⠁⠉⠛⠒⠚⠋⠁⠀⠀⠀⠀⠀⠀
-            """),
+            Label(ASCII_DOG),
             id="ascii_dog",
         )
 
@@ -149,6 +234,13 @@ class Beatrice(App):
             classes="online_user_list hidden",
         )
 
+        # Message input, shown once a valid nickname has been entered
+        yield Input(
+            placeholder="Enter your message here...",
+            id="message_input",
+            classes="message_input hidden",
+        )
+
     def action_quit(self) -> None:
         self.exit()
 
@@ -160,17 +252,46 @@ class Beatrice(App):
         self.client = None
         self.processor_task = None
         self.receiver_task = None
+        self.sender_task = None
+
+        # Messages typed by the user, waiting to be encrypted and sent
+        self._outbox: asyncio.Queue[str | None] = asyncio.Queue()  # None stops the sender
 
         # Focus the nickname input on start up
         self.nickname_input = self.query_one("#nickname_input").focus()
 
-        self.set_interval(2, self.update_online_users_display)
-        self.inactivity_timer = datetime.now()
+        # Resolve the widgets used on every event once, instead of per event
+        self._chat_log = self.query_one("#chat_log", VerticalScroll)
+        self._online_user_log = self.query_one("#online_user_log", Container)
+        self._online_list = self.query_one("#online_list", ListView)
+        self._message_input = self.query_one("#message_input", Input)
 
-    async def on_input_submitted(self, event: Input.Submitted):
+        # Users shown in the online list, keyed by nickname
+        self._online_widgets: dict[str, ListItem] = {}
+        self._own_online_item: ListItem | None = None
+
+        # time.monotonic() of the last key press or click
+        self.inactivity_timer = time.monotonic()
+
+        # Set while a debounced scroll_end is waiting to run
+        self._scroll_pending = False
 
-        chat_log = self.query_one("#chat_log")
-        online_user_log = self.query_one("#online_user_log")
+        # Every chat log row lives here, only the newest ones stay mounted
+        self.store = MessageStore()
+
+        # Event type -> method building its chat log row, looked up once per event
+        self._dispatch = {
+            "message": self._h_message,
+            "my_message": self._h_my_message,
+            "join_packet": self._h_join,
+            "dir": self._h_dir,
+            "leave_packet": self._h_leave,
+            "self_message_error": self._h_self_error,
+        }
+
+        self.watch(self._chat_log, "scroll_y", self._on_chat_log_scroll, init=False)
+
+    async def on_input_submitted(self, event: Input.Submitted):
 
         # /--- if the input is a nickname input, validate it and start the program
         if event.input.id == "nickname_input":
@@ -190,15 +311,15 @@ class Beatrice(App):
                     self.nickname: str = self.nickname_input.value.strip()
 
                     # remove the input field from the screen
-                    self.query_one("#nickname_input").remove()
+                    self.nickname_input.remove()
                     self.query_one("#login_title_container").remove()
                     self.query_one("#ascii_dog").remove()
 
                     # /-- Make the chat log and online user log appear only after a valid nickname is inputted
-                    chat_log = self.query_one("#chat_log")
+                    chat_log = self._chat_log
                     chat_log.remove_class("hidden")
 
-                    online_user_log = self.query_one("#online_user_log")
+                    online_user_log = self._online_user_log
                     online_user_log.remove_class("hidden")
                     # --/
 
@@ -211,62 +332,134 @@ class Beatrice(App):
                         )
                     )
 
-                    # init the vertical scroll and input widgets for the ui
-                    await self.mount(
-                        Input(
-                            placeholder="Enter your message here...",
-                            id="message_input",
-                            classes="message_input",
-                        )
-                    )
+                    # show the message input, it was created hidden in compose
+                    self._message_input.remove_class("hidden")
 
                     # Create a new client and connect to the server
-                    self.client = Client(args.host, args.port, self.nickname)
-
-                    # Start server connection after nickname is submitted
-                    await self.client.connect_to_server(
-                        self.client.host, self.client.port
+                    self.client = await Client.create(
+                        self.server_host, self.server_port, self.nickname
                     )
 
-                    # perform handshake
-                    await self.client.check_handshake()
+                    # Connect to the server and perform the handshake
+                    await self.client.connect_and_handshake()
+
+                    # fill the online list from the directory sent on
+                    # handshake, joins and leaves keep it up to date after
+                    await self.update_online_users_display()
+
+                    # These three run for the life of the app, so plain tasks
+                    # are enough and skip Textual's worker bookkeeping. Nothing
+                    # awaits them, so _on_task_done reports a crash instead.
 
                     # start receive_messages indefinitely
-                    self.receiver_task = self.run_worker(
-                        self.client.receive_messages())
+                    self.receiver_task = asyncio.create_task(
+                        self.client.receive_messages(), name="receiver"
+                    )
 
                     # start process to look at queue
-                    self.processor_task = self.run_worker(
-                        self.process_events())
+                    self.processor_task = asyncio.create_task(
+                        self.process_events(), name="processor"
+                    )
+
+                    # start the single task that sends everything typed
+                    self.sender_task = asyncio.create_task(
+                        self._send_loop(), name="sender"
+                    )
+
+                    for task in (
+                        self.receiver_task,
+                        self.processor_task,
+                        self.sender_task,
+                    ):
+                        task.add_done_callback(self._on_task_done)
 
                     # Focus the message input after valid nickname input
-                    self.query_one("#message_input").focus()
+                    self._message_input.focus()
 
             # ---/
 
-        # If the input is a message, send it by calling send_message method
-        # from client.py
+        # If the input is a message, queue it for the sender task which calls
+        # the send_message method from client.py
         elif event.input.id == "message_input":
             message = event.value
-            if self.client is not None:
-                await self.client.send_message(message)
             event.input.value = ""
+
+            # if the user enters quit or exit, stop the program
+            if message.strip().lower() in QUIT_COMMANDS:
+                self.exit()
+                return
+
+            if self.client is not None:
+                self._outbox.put_nowait(message)
         # ---/
 
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        """
+        Exit with the error if one of the background tasks crashed, the same
+        as a worker with exit_on_error would. Otherwise the loop would just
+        stop and the UI would hang waiting on it.
+        """
+        if task.cancelled():
+            return
+
+        error = task.exception()
+        # A SystemExit is a request to quit, not a crash
+        if isinstance(error, SystemExit):
+            self.exit(return_code=error.code if isinstance(error.code, int) else 0)
+        elif error is not None:
+            self.exit(
+                return_code=1,
+                message=f"{task.get_name()} task failed: {error!r}",
+            )
+
+    async def _send_loop(self):
+        """
+        Sends queued messages in the background, so submitting a message never
+        waits on its encryption or on the network. Messages that queued up
+        while the last batch was sending are encrypted together and go out in
+        one write.
+        """
+        while True:
+            messages = [await self._outbox.get()]
+            while not self._outbox.empty():
+                messages.append(self._outbox.get_nowait())
+
+            if self.client is None:
+                continue
+
+            # Whatever happens part way through the batch, the messages
+            # already encrypted (and shown as sent) still go out
+            try:
+                for message in messages:
+                    # None is queued by on_unmount, everything before it is sent
+                    if message is None:
+                        return
+                    await self.client.send_message(message, flush=False)
+            finally:
+                await self.client.flush()
+
     def _on_app_focus(self, event: events.AppFocus) -> None:
 
-        if self.client:
-            self.query_one("#message_input").focus()
+        # Refocus whichever input is in use, the nickname one until it is
+        # removed on login
+        if self.nickname_input.is_attached:
+            self.nickname_input.focus()
         else:
-            self.query_one("#nickname_input")
+            self._message_input.focus()
+
+    def _reset_inactivity_timer(self) -> None:
+        # At most once a second, there's no need to stamp every key press
+        now = time.monotonic()
+        if now - self.inactivity_timer > ACTIVITY_RESOLUTION:
+            self.inactivity_timer = now
 
     def on_key(self, event: events.Key):
         # Reset inactivity_timer on any key input
-        self.inactivity_timer = datetime.now()
+        self._reset_inactivity_timer()
 
     def on_click(self, event: events.Click):
         # Reset inactivity_timer on any key input
-        self.inactivity_timer = datetime.now()
+        self._reset_inactivity_timer()
 
     # TODO: Add logic to have the app resize certain elements on terminal
     # window resize
@@ -277,8 +470,12 @@ class Beatrice(App):
 
         is_small = width < 75
 
-        chat_log = self.query_one("#chat_log")
-        online_user_log = self.query_one("#online_user_log")
+        # The widgets are cached in on_mount, there's nothing to resize before that
+        if not hasattr(self, "_chat_log"):
+            return
+
+        chat_log = self._chat_log
+        online_user_log = self._online_user_log
 
         # if is_small:
         #     chat_log.add_class("compact-mode")
@@ -287,116 +484,182 @@ class Beatrice(App):
         #     chat_log.remove_class("compact-mode")
         #     online_user_log.remove_class("hidden")
 
-    # Method to get things from the event queue and do something with them
-    # depending on what it is.
-    async def process_events(self):
+    def _build_widget(self, data: MessageData) -> Widget:
+        """Turn a stored MessageData back into the widget shown in the chat log"""
+        row_classes = MESSAGE_ROW_CLASSES.get(data.kind)
+        if row_classes is not None:
+            return Container(
+                TimestampLabel(
+                    data.content,
+                    prefix=data.prefix,
+                    timestamp=data.ts,
+                    classes=BUBBLE_CLASSES,
+                ),
+                classes=row_classes,
+            )
+
+        # join, dir and leave rows are all plain system messages
+        label_classes, row_classes = SYSTEM_ROW_CLASSES[data.kind]
+        return Container(
+            Label(data.content, classes=label_classes),
+            classes=row_classes,
+        )
 
-        while True:
+    async def _mount_messages(self, rows: list[MessageData]) -> None:
+        """Store the rows, mount them in one go and prune anything outside the window"""
+        if not rows:
+            return
 
-            event_type = None
-            content = None
+        widgets = []
+        for data in rows:
+            index = self.store.append(data)
+            widget = self._build_widget(data)
+            self.store.mounted[index] = widget
+            widgets.append(widget)
+
+        # One mount for the whole batch, and the prune that follows it, are
+        # rendered together as a single compositor update
+        with self.batch_update():
+            await self._chat_log.mount_all(widgets)
+            self._prune_old_messages()
+
+    def _prune_old_messages(self) -> None:
+        """Unmount the oldest rows so only MESSAGE_WINDOW_SIZE stay in the DOM"""
+        chat_log = self._chat_log
+
+        # Leave the rows alone while the user is scrolled up reading them
+        if chat_log.scroll_y < chat_log.max_scroll_y:
+            return
 
-            # Get the events from the queue and handle them appropriately
-            if self.client is not None:
-                event_type, content = await self.client.event_queue.get()
-
-            # Get reference to the chat_log and online_user_log from the DOM
-            chat_log = self.query_one("#chat_log")
-            online_user_log = self.query_one("#online_user_log")
-
-            if event_type:
-
-                # if the event packet begins with "M", then it is a message
-                # from someone. We then call receive_message
-                if event_type == "message":
-                    sender = content.get("sender")
-                    message = content.get("content")
-                    recipient = content.get("recipient")
-
-                    fingerprint = self.client.get_fingerprint(sender)
-
-                    if message.startswith("@"):
-                        await chat_log.mount(
-                            Container(
-                                TimestampLabel(
-                                    message[1:],
-                                    prefix=f"DM from {sender} ({fingerprint}): \n",
-                                    classes="bubble",
-                                ),
-                                classes="message_row received",
-                            )
-                        )
-                    else:
-                        await chat_log.mount(
-                            Container(
-                                TimestampLabel(
-                                    message,
-                                    prefix=f"{sender} ({fingerprint}): \n",
-                                    classes="bubble",
-                                ),
-                                classes="dm_message_row received",
-                            )
-                        )
+        # The newest row is never pruned, the window always ends on it
+        while len(self.store.mounted) > MESSAGE_WINDOW_SIZE:
+            self.store.mounted.pop(self.store.first_mounted).remove()
+
+    def _on_chat_log_scroll(self, scroll_y: float) -> None:
+        # Bring older rows back once the user reaches the top of the chat log
+        first = self.store.first_mounted
+        if scroll_y <= 0 and first:
+            self.run_worker(
+                self._hydrate_messages_above(), group="hydrate", exclusive=True
+            )
+
+    async def _hydrate_messages_above(self) -> None:
+        """Re-mount the rows just above the oldest mounted one"""
+        first = self.store.first_mounted
+        if not first:
+            return
 
-                # If the event_type is my_message, display it on the screen
-                elif event_type == "my_message":
-                    message = content.get("content")
+        start = max(0, first - HYDRATE_BATCH_SIZE)
+        widgets = [self._build_widget(self.store.messages[i]) for i in range(start, first)]
+
+        chat_log = self._chat_log
+        await chat_log.mount_all(widgets, before=self.store.mounted[first])
+        self.store.mounted.update(zip(range(start, first), widgets))
+
+        # Keep the row the user was looking at in the same place on screen
+        chat_log.scroll_to(y=len(widgets) * ESTIMATED_ROW_HEIGHT, animate=False)
+
+    def _schedule_scroll(self) -> None:
+        """Scroll to the newest row, at most once every SCROLL_DEBOUNCE seconds"""
+        if not self._scroll_pending:
+            self._scroll_pending = True
+            self.set_timer(SCROLL_DEBOUNCE, self._flush_scroll)
+
+    def _flush_scroll(self) -> None:
+        self._scroll_pending = False
+        self._chat_log.scroll_end(animate=False)
+
+    def _build_row(self, event_type: str, content) -> MessageData | None:
+        """
+        Turn a single event from the client into the chat log row it should
+        display. Returns None for events that don't add a row.
+        """
+        handler = self._dispatch.get(event_type)
+        if handler is None:
+            return None
+        return handler(content)
+
+    # if the event packet begins with "M", then it is a message from someone
+    def _h_message(self, content) -> MessageData:
+        sender = content.get("sender")
+        message = content.get("content")
+
+        # Fingerprints are worked out when the key arrives, this is a dict read
+        fingerprint = self.client.fingerprints.get(sender, "Unknown")
+
+        if message.startswith("@"):
+            return MessageData(
+                "received_dm",
+                message[1:],
+                prefix=f"DM from {sender} ({fingerprint}): \n",
+                ts=TimestampLabel.get_timestamp(),
+            )
+        return MessageData(
+            "received",
+            message,
+            prefix=f"{sender} ({fingerprint}): \n",
+            ts=TimestampLabel.get_timestamp(),
+        )
 
-                    # send the information to it
-                    await chat_log.mount(
-                        Container(
-                            TimestampLabel(
-                                message, prefix="Me: \n", classes="bubble"),
-                            classes="message_row sent",
-                        )
-                    )
+    # our own message, display it on the screen
+    def _h_my_message(self, content) -> MessageData:
+        return MessageData(
+            "sent",
+            content.get("content"),
+            prefix=ME_PREFIX,
+            ts=TimestampLabel.get_timestamp(),
+        )
 
-                # if the event type is the join packet notify the users that
-                # someone has connected
-                elif event_type == "join_packet":
+    # notify the users that someone has connected
+    def _h_join(self, content) -> MessageData:
+        return MessageData("join", f"{content}")
 
-                    # send the information to it
-                    await chat_log.mount(
-                        Container(
-                            Label(f"{content}", classes="join_message"),
-                            classes="join_packet",
-                        )
-                    )
+    # notify the users how many people are connected
+    def _h_dir(self, content) -> MessageData:
+        return MessageData("dir", f"{content}")
 
-                # if the event type is dir notify the users how many people are
-                # connected
-                elif event_type == "dir":
+    # notify the users who left the chat
+    def _h_leave(self, content) -> MessageData:
+        return MessageData("leave", f"{content}")
 
-                    # Display the number of connected users
-                    await chat_log.mount(
-                        Container(
-                            Label(f"{content}", classes="dir_message"),
-                            classes="dir_packet",
-                        )
-                    )
+    def _h_self_error(self, content) -> None:
+        self.notify(
+            "You cannot send a message to yourself.",
+            severity="error",
+            timeout=10,
+        )
 
-                # if event type is leave packet notify the users who left the
-                # chat
-                elif event_type == "leave_packet":
+    # Method to get things from the event queue and do something with them
+    # depending on what it is.
+    async def process_events(self):
 
-                    # get the chat log info and send the information to it
-                    chat_log = self.query_one("#chat_log")
-                    await chat_log.mount(
-                        Container(
-                            Label(f"{content}", classes="leave_message"),
-                            classes="leave_packet",
-                        )
-                    )
+        while True:
 
-                elif event_type == "self_message_error":
-                    chat_log = self.query_one("#chat_log")
-                    self.notify(
-                        "You cannot send a message to yourself.",
-                        severity="error",
-                        timeout=10,
-                    )
+            batch = []
 
-            self.call_after_refresh(chat_log.scroll_end, animate=False)
+            # Wait for the next event, then drain anything else that queued up
+            # in the meantime so a burst is handled in a single pass. The drain
+            # is capped so a flood can't starve the rest of the UI.
+            if self.client is not None:
+                queue = self.client.event_queue
+                batch.append(await queue.get())
+                batch += queue.drain(MAX_BATCH - 1)
+
+            # Build every row in the batch first, then mount them together
+            rows = [
+                row
+                for event_type, content in batch
+                if (row := self._build_row(event_type, content)) is not None
+            ]
+
+            # Events like self_message_error add no rows, nothing to scroll to
+            if rows:
+                await self._mount_messages(rows)
+                self._schedule_scroll()
+
+            # Only touch the online list when someone joined or left
+            if any(event_type in ROSTER_EVENTS for event_type, _ in batch):
+                await self.update_online_users_display()
 
     # TODO: This currently turns all users to away even if they aren't. Probs
     # make sense for the server to handle this. Will add...
@@ -405,28 +668,43 @@ class Beatrice(App):
         if not self.client:
             return
 
-        # Get the usernames from client
-        users = [
-            user
-            for user in await self.client.display_connected_users()
-            if user != self.nickname
-        ]
+        # Get the usernames from client, the view minus ourselves is one set
+        online_users = await self.client.display_connected_users() - {self.nickname}
+
+        # Nothing changed since the last refresh, leave the list alone
+        if self._own_online_item is not None and online_users == self._online_widgets.keys():
+            return
 
         # Get the online list from the DOM
-        online_list = self.query_one("#online_list")
+        online_list = self._online_list
 
-        # Clear existing items
-        online_list.clear()
+        # Our own entry never changes, so it is only added once
+        if self._own_online_item is None:
+            self._own_online_item = ListItem(Label(f"⭐ {self.nickname} (Me)"))
+            online_list.append(self._own_online_item)
 
-        online_list.append(ListItem(Label(f"⭐ {self.nickname} (Me)")))
+        # Remove the users who have left
+        for user in self._online_widgets.keys() - online_users:
+            self._online_widgets.pop(user).remove()
 
-        # Add new items
-        for user in users:
-            online_list.append(ListItem(Label(f"🟢 {user}")))
+        # Add the users who have joined
+        for user in online_users - self._online_widgets.keys():
+            item = ListItem(Label(f"🟢 {user}"))
+            online_list.append(item)
+            self._online_widgets[user] = item
 
     async def on_unmount(self):
         # Cancel any ongoing tasks when the app is unmounted
         if hasattr(self, "client") and self.client:
+            # Let the sender finish and flush what was typed before quitting,
+            # while the processor is still there to take its events
+            if self.sender_task:
+                self._outbox.put_nowait(None)
+                try:
+                    await asyncio.wait_for(self.sender_task, SHUTDOWN_TIMEOUT)
+                except Exception:
+                    pass
+
             if self.receiver_task:
                 self.receiver_task.cancel()
             if self.processor_task:
@@ -438,5 +716,14 @@ class Beatrice(App):
 
 
 if __name__ == "__main__":
-    app = Beatrice()
+    # uvloop is optional, without it Textual runs on the default asyncio loop
+    try:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    args = _parse_args()
+    app = Beatrice(args.host, args.port)
     app.run()
@@ -1,13 +1,16 @@
 import asyncio
-import base64
+import binascii
 import hashlib
 import json
 import logging
+import operator
 import os
 import secrets
+import socket
+import struct
 import sys
 from collections import deque
-from typing import Any, List, Optional, Tuple, Union
+from typing import Any, Callable, List, Optional, Tuple, Union
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
@@ -17,6 +20,35 @@ from cryptography.hazmat.primitives.asymmetric.rsa import (RSAPrivateKey,
                                                            RSAPublicKey)
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+# orjson is optional, it's a faster drop-in for the json on the packet path.
+# Both versions dump straight to bytes and load from bytes or str.
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+
+    def json_dumps(obj: Any) -> bytes:
+        # Compact and unescaped, the same bytes orjson would produce
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode(
+            "utf-8"
+        )
+
+    json_loads = json.loads
+
+# pybase64 is optional too, it uses SIMD where the CPU supports it
+try:
+    import pybase64
+
+    b64decode = pybase64.b64decode
+    b64encode = pybase64.b64encode_as_string
+except ImportError:
+    b64decode = binascii.a2b_base64
+
+    def b64encode(data: bytes) -> str:
+        return binascii.b2a_base64(data, newline=False).decode("ascii")
+
 # Type definitions
 Event = Union[
     Tuple[str, str, str],  # ("message", sender, content)
@@ -35,9 +67,112 @@ MAX_PACKET_LENGTH = 256 * 1024  # 256kb (should be large enough)
 RSA_KEY_SIZE = 2048
 AES_KEY_SIZE = 256
 TARGET_PAYLOAD_SIZE = 4096
+EVENT_QUEUE_SIZE = 1024  # Max number of events waiting for the UI
+SOCKET_BUFFER_SIZE = 1 << 20  # 1MiB kernel send/receive buffers
+FRAME_HEADER = struct.Struct(">I")  # 4 byte big-endian length in front of every packet
+JSON_LENGTH = struct.Struct(">I")  # Length of the JSON header, the raw payload follows it
+MESSAGE_FIELDS = operator.itemgetter("s", "m", "k", "w", "iv", "h")  # Fields every "M" packet needs
+
+# Hash and padding objects hold no state, so build them once and share them
+SHA256 = hashes.SHA256()
+OAEP_PADDING = padding.OAEP(mgf=padding.MGF1(algorithm=SHA256), algorithm=SHA256, label=None)
+PSS_PADDING = padding.PSS(mgf=padding.MGF1(SHA256), salt_length=padding.PSS.MAX_LENGTH)
+
+def encode_packet(packet: dict[str, Any], payload: bytes = b"") -> bytes:
+    """
+    Serialize a packet to JSON and prefix it with its length.
+
+    Frame layout: [length][json length][json header][payload]. The payload is
+    raw bytes (the ciphertext of a message), so it never goes through base64.
+    """
+    header = json_dumps(packet)
+    return (
+        FRAME_HEADER.pack(JSON_LENGTH.size + len(header) + len(payload))
+        + JSON_LENGTH.pack(len(header))
+        + header
+        + payload
+    )
+
+
+def decode_packet(message: bytes) -> dict[str, Any]:
+    """
+    Inverse of encode_packet, message is the frame without its length prefix.
+    A payload, if there is one, is stored under "m" as a memoryview of the
+    frame so it is not copied.
+    """
+    (header_length,) = JSON_LENGTH.unpack_from(message)
+    end = JSON_LENGTH.size + header_length
+    packet = json_loads(message[JSON_LENGTH.size : end])
+    if end < len(message):
+        packet["m"] = memoryview(message)[end:]
+    return packet
+
+
+class FastQueue:
+    """
+    Multi producer, single consumer queue for events going to the UI.
+
+    A deque plus two asyncio Events, so putting or getting an item that is
+    already available never allocates a Future the way asyncio.Queue does.
+    Bounded by maxsize, put waits while the queue is full. There are several
+    producers (receive_messages and send_message), so put re-checks the size
+    in a loop after every wakeup, another producer may have filled the space.
+    """
+
+    def __init__(self, maxsize: int = 0) -> None:
+        self._items: deque[Event] = deque()
+        self._maxsize: int = maxsize
+        self._not_empty: asyncio.Event = asyncio.Event()
+        self._not_full: asyncio.Event = asyncio.Event()
+        self._not_full.set()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    async def put(self, item: Event) -> None:
+        # Only wait when the UI has fallen behind
+        while self._maxsize and len(self._items) >= self._maxsize:
+            self._not_full.clear()
+            await self._not_full.wait()
+        self.put_nowait(item)
+
+    def put_nowait(self, item: Event) -> None:
+        self._items.append(item)
+        self._not_empty.set()
+
+    async def get(self) -> Event:
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        item = self._items.popleft()
+        self._not_full.set()
+        return item
+
+    def drain(self, limit: int) -> list[Event]:
+        """Pop up to limit items that are already queued, without waiting"""
+        items = self._items
+        batch = [items.popleft() for _ in range(min(limit, len(items)))]
+        self._not_full.set()
+        return batch
+
+
+def generate_private_key() -> RSAPrivateKey:
+    return rsa.generate_private_key(
+        public_exponent=65537, key_size=RSA_KEY_SIZE, backend=default_backend()
+    )
+
 
 class Client:
-    def __init__(self, host: str, port: int, nickname: str) -> None:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        nickname: str,
+        private_key: Optional[RSAPrivateKey] = None,
+    ) -> None:
         # /--- Store host & port, set nickname
         self.host: str = host
         self.port: int = port
@@ -49,17 +184,18 @@ class Client:
         self.writer: Optional[asyncio.StreamWriter] = None
 
         # Queue for sending events to the UI
-        self.event_queue: asyncio.Queue[Event] = asyncio.Queue(maxsize=100)
+        self.event_queue: FastQueue = FastQueue(maxsize=EVENT_QUEUE_SIZE)
+
+        # Encoded frames built by send_message(flush=False), waiting for flush()
+        self._pending_packets: list[bytes] = []
         # ---/
 
         # Init connected status as false since we are not connected yet
         self.connected: bool = False
 
         # --- CRYPTO SETUP ---
-        # /--- Public and private key generation
-        self.private_key: RSAPrivateKey = rsa.generate_private_key(
-            public_exponent=65537, key_size=RSA_KEY_SIZE, backend=default_backend()
-        )
+        # /--- Public and private key generation, unless create() already made one
+        self.private_key: RSAPrivateKey = private_key or generate_private_key()
         self.public_key: RSAPublicKey = self.private_key.public_key()
         # ---/
 
@@ -78,14 +214,50 @@ class Client:
         # Store other users public keys
         self.user_public_keys: dict[str, RSAPublicKey] = {}
 
+        # AES session keys, one per peer. RSA only wraps a session key once per
+        # peer, every message after that only costs an AES-GCM pass.
+        # The AESGCM objects themselves are kept so OpenSSL sets up the key
+        # schedule once per session rather than once per message.
+        # Outgoing: recipient -> (cipher's bound encrypt, base64 RSA-wrapped key sent as "k")
+        self.session_keys: dict[str, tuple[Callable[..., bytes], str]] = {}
+        # Incoming: sender -> ("k" as received, cipher)
+        self.peer_session_keys: dict[str, tuple[str, AESGCM]] = {}
+
+        # Fingerprints are stable per key, so they're computed once when the key
+        # is stored. Public so the UI can read one without a method call
+        self.fingerprints: dict[str, str] = {}
+
         # /--- Init handshake packet data
         self.handshake_packet: dict[str, str] = {
             "t": "H",
             "n": self.nickname,
             "k": self.public_key_str,
         }
+
+        # Our key never changes, so the handshake frame is only encoded once
+        self._handshake_frame: bytes = encode_packet(self.handshake_packet)
         # ---/
 
+        # Packet type -> handler, receive_messages does one dict lookup per packet
+        self._packet_handlers = {
+            "M": self._handle_message,
+            "J": self._handle_join,
+            "DIR": self._handle_dir,
+            "L": self._handle_leave,
+            "ERR": self._handle_error,
+        }
+
+    @classmethod
+    async def create(cls, host: str, port: int, nickname: str) -> "Client":
+        """
+        Build a Client, generating its RSA key pair in a worker thread.
+
+        Key generation is hundreds of milliseconds of CPU, and cryptography
+        releases the GIL while it runs, so the event loop stays responsive.
+        """
+        private_key = await asyncio.to_thread(generate_private_key)
+        return cls(host, port, nickname, private_key=private_key)
+
     @property
     def reader(self) -> asyncio.StreamReader:
         """
@@ -122,74 +294,61 @@ class Client:
         Time Complexity: O(1) - single connection attempt
         """
         try:
+            # limit sets how much the reader buffers before pausing the socket,
+            # match it to the largest packet so a big one arrives without stalls
             self._reader, self.writer = await asyncio.open_connection(
-                host, port
+                host, port, limit=MAX_PACKET_LENGTH
             )  # Import host & port from server side logic
         except ConnectionRefusedError:
             logger.error(f"Could not connect to host and port.")
             raise Exception("Unable to connect to host and port.")
 
-    # helper method to avoid re-writing the same lines of code over and over
-    async def _send_packet(self, packet: dict[str, Any]):
-        """
-        1. Encodes the packet to JSON bytes (with newline).
-        2. Writes it to the specific writer.
-        3. Drains the writer to ensure it sent.
-        Safety: Wrap in try/except to ignore broken pipes.
-        """
-        try:
-            # Encodes the packet to bytes and writes it to the writer, followed by a newline.
-
-            self.writer.write((json.dumps(packet) + "\n").encode("utf-8"))
-
-            # Drains the writer's buffer, ensuring that all data has been sent.
-            if self.writer is None:
-                logger.error("No connection.")
-                return
-
-            await self.writer.drain()
-
-        # If an exception occurs
-        except Exception as e:
-            logger.warning(f"Error sending packet: {e}")
-            return
+        # Chat packets are small and interactive, so turn off Nagle and give the
+        # kernel enough buffer room to absorb bursts (e.g. a large DIR packet)
+        sock = self.writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
 
     # helper method to avoid re-writing the same lines of code over and over
     async def _receive_packet(self) -> dict[str, Any] | None:
         """
-        1. Receives incoming data from the network stream
-        2. Checks if data is empty, which indicates no new data is available
+        1. Reads the 4 byte length header, then exactly that many bytes
+        2. Returns None if the server disconnected or the packet is too large
         3. Convert the received data into JSON format using json.loads() and return it
         Safety: Wrap in try/except to ignore broken pipes.
         """
         try:
-            # Receive messages and assign to a variable.
-            # The message comes in as bytes. decode to utf-8 string format for processing.
-            message: bytes = await self.reader.readline()
-        except Exception as e:
-            logger.error(f"Socket read error {e}")
-            raise e
+            # Every packet is prefixed with its length, so we know exactly how
+            # much to read and never have to scan the stream for a delimiter
+            header = await self.reader.readexactly(FRAME_HEADER.size)
+            (length,) = FRAME_HEADER.unpack(header)
 
-        if len(message) > MAX_PACKET_LENGTH:
-            logger.error("Packet too large.")
-            return None
+            # Check the length before reading so an oversized packet is never buffered
+            if length > MAX_PACKET_LENGTH:
+                logger.error("Packet too large.")
+                return None
 
-        # if an empty string is received, this means the client has disconnected.
-        if not message or message == b"":
-            logger.error("Client disconnected")
-            return None
+            message: bytes = await self.reader.readexactly(length)
 
-        # if no message is received or an empty message is received, do nothing
-        if not message or message == b"\n":
+        # readexactly raises this if the connection closes part way through,
+        # which means the server has disconnected.
+        except asyncio.IncompleteReadError:
+            logger.error("Client disconnected")
             return None
+        except Exception as e:
+            logger.error(f"Socket read error {e}")
+            raise e
 
         try:
-            # decrypt the utf8 message into JSON packet if its valid json
-            packet: dict[str, str] = json.loads(message.decode("utf-8"))
+            # json_loads reads the utf8 bytes straight from the stream buffer,
+            # so there is no intermediate str copy of every packet
+            packet: dict[str, Any] = decode_packet(message)
             return packet
 
-        # json error if there is an invalid json
-        except json.JSONDecodeError as e:
+        # json error if there is an invalid json, struct error if the frame is too short
+        except (json.JSONDecodeError, struct.error) as e:
             logger.warning(f"Invalid JSON received: {e}")
             pass
 
@@ -202,26 +361,50 @@ class Client:
 
         """
         try:
+            # Nicknames come off the network, so don't assume they're strings
+            if not isinstance(nickname, str):
+                logger.error(f"Invalid nickname {nickname!r}, key not stored.")
+                return
+
+            # One shared str object per nickname, so the per-user dicts all hold the
+            # same key and lookups with an interned sender match on identity
+            nickname = sys.intern(nickname)
+
             public_key = serialization.load_pem_public_key(
                 public_key_str.encode("utf-8"), backend=default_backend()
             )
+
+            # Checked once here, so the send path can use the loaded key as is
+            if not isinstance(public_key, RSAPublicKey):
+                logger.error(f"Public key for {nickname} is not an RSA key.")
+                return
+
             self.user_public_keys[nickname] = public_key
+
+            # Worked out once per key, every message after is a dict lookup
+            self.fingerprints[nickname] = self._compute_fingerprint(public_key)
+
+            # A new key means a new peer, any session with the old one is stale
+            self.session_keys.pop(nickname, None)
+            self.peer_session_keys.pop(nickname, None)
         except Exception as e:
             logger.error(f"Error storing public key for {nickname}: {e}")
 
     def get_fingerprint(self, nickname) -> str:
         """
-        Generate a short, readable hex representation of the fingerprint for a given public key
+        Short, readable hex fingerprint of a user's public key, computed when
+        the key was stored. "Unknown" if we don't have a key for them.
         """
+        return self.fingerprints.get(nickname, "Unknown")
 
-        # If the nickname is not in public keys, return "Unknown"
-        if nickname not in self.user_public_keys:
-            return "Unknown"
-
-        # Get the public key for that user
-        key = self.user_public_keys[nickname]
+    @staticmethod
+    def _compute_fingerprint(key: RSAPublicKey) -> str:
+        """
+        Generate a short, readable hex representation of the fingerprint for a given public key
+        """
 
-        # Serialize it to bytes
+        # Serialize it to bytes. Re-serializing rather than hashing the PEM we
+        # were sent keeps the fingerprint the same however the PEM was formatted
         key_bytes = key.public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo,
@@ -233,27 +416,39 @@ class Client:
         # return the first 4 characters and last 4 characters of sha256 hash
         return f"{sha[:4]}:{sha[4:8]}"
 
-    async def check_handshake(self) -> bool | None:
+    async def connect_and_handshake(self) -> bool | None:
         """
-        Async method to check the client handshake response. If successful, the client public key is stored in the Client class object so messages can be sent to and from the connected client(s).
+        Connect to the server and send the handshake in one go.
 
-        If no key is received, then the chat is closed as encryption can't be guaranteed.
+        The handshake is written straight after the connection opens without
+        waiting on drain, the freshly connected socket has an empty buffer so
+        the bytes go out immediately and we move straight on to reading the
+        server's reply.
 
         Returns:
             True if handshake successful, False otherwise.
         """
+        await self.connect_to_server(self.host, self.port)
 
-        # Send the Handshake Packet immediately
         try:
-            await self._send_packet(self.handshake_packet)
-
-        # If there is an error while sending the packet, then log and exit
+            self.writer.write(self._handshake_frame)
         except Exception as e:
             logger.error(
                 f"Error sending handshake: {e}! Exiting. Please try reconnecting. "
             )
             return False
 
+        return await self._read_handshake_response()
+
+    async def _read_handshake_response(self) -> bool | None:
+        """
+        Read the server's reply to our handshake and store the keys of the users
+        already connected.
+
+        Returns:
+            True if handshake successful, False otherwise.
+        """
+
         # Listen for response (The server might send ERR or DIR)
         # If successful, Server sends nothing specific back immediately,
         # it just proceeds to _synchronise and sends the DIR packet.
@@ -341,7 +536,10 @@ class Client:
         Continuously listens for packets from the server and handles them.
 
         Processes different packet types: messages, errors, directory updates, etc.
+        Each type has its own _handle_* method, looked up in _packet_handlers.
         """
+        handlers = self._packet_handlers
+
         while True:
 
             # Async receiving to avoid blocking the main thread
@@ -351,179 +549,202 @@ class Client:
             if not packet:
                 break
 
-            # Get the type of packet
-            packet_type = packet.get("t")
-
-            # TODO: Could refactor this by splitting the decryption part into its own method, might look cleaner
-            # --- MESSAGE PACKET ---
-            if packet_type == "M":
-                # Handle message
-                sender = packet.get("s")
-                encrypted_msg_b64 = packet.get("m")
-                encrypted_key_b64 = packet.get("k")
-                iv_b64 = packet.get("iv")
-                signature_b64 = packet.get("h")
-
-                # check to see if all parts of the message packet have been received, if not, chuck em out and log an error
-                if not all(
-                    [
-                        sender,
-                        encrypted_msg_b64,
-                        encrypted_key_b64,
-                        iv_b64,
-                        signature_b64,
-                    ]
-                ):
-                    logger.error("Message packet incomplete")
-                    continue
-
-                try:
-                    # Decode from base64
-                    encrypted_key = base64.b64decode(encrypted_key_b64)
-                    encrypted_message = base64.b64decode(encrypted_msg_b64)
-                    iv = base64.b64decode(iv_b64)
-                    signature = base64.b64decode(signature_b64)
-
-                    # Decrypt the aes key with the private rsa key
-                    aes_key = self.private_key.decrypt(
-                        encrypted_key,
-                        padding.OAEP(
-                            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                            algorithm=hashes.SHA256(),
-                            label=None,
-                        ),
-                    )
+            # Look up the handler for this type of packet, unknown types are ignored
+            handler = handlers.get(packet.get("t"))
+            if handler is not None:
+                await handler(packet)
 
-                    # decrypt the content via aes
-                    aesgcm = AESGCM(aes_key)
+    # --- MESSAGE PACKET ---
+    async def _handle_message(self, packet: dict[str, Any]) -> None:
+        # Handle message. All the fields come out in one C-level call,
+        # a missing one raises KeyError.
+        try:
+            (
+                sender,
+                encrypted_message,
+                encrypted_key_b64,
+                wrapped_key_b64,
+                iv_b64,
+                signature_b64,
+            ) = MESSAGE_FIELDS(packet)
+        except KeyError:
+            logger.error("Message packet incomplete")
+            return
 
-                    decrypted_content_bytes = aesgcm.decrypt(
-                        iv, encrypted_message, None
-                    )
+        # check to see if all parts of the message packet have been received, if not, chuck em out and log an error
+        if not (
+            sender
+            and encrypted_message
+            and encrypted_key_b64
+            and wrapped_key_b64
+            and iv_b64
+            and signature_b64
+        ):
+            logger.error("Message packet incomplete")
+            return
 
-                    # Create local hash of the content to compare against the hash received
-                    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-                    digest.update(decrypted_content_bytes)
-                    payload_hash = digest.finalize()
-
-                    # Get senders public key to use to verify the signature
-                    sender_public_key = self.user_public_keys.get(sender)
-
-                    if not sender_public_key:
-                        logger.error(f"No public key for {sender}")
-                        continue
-
-                    try:
-                        sender_public_key.verify(
-                            signature,
-                            payload_hash,
-                            padding.PSS(
-                                mgf=padding.MGF1(hashes.SHA256()),
-                                salt_length=padding.PSS.MAX_LENGTH,
-                            ),
-                            hashes.SHA256(),
-                        )
-                    except Exception as e:
-                        logger.error(
-                            f"SECURITY: Invalid signature from {sender}. Message rejected. {e}"
-                        )
-                        continue
+        try:
+            if not isinstance(sender, str):
+                logger.error(f"Invalid sender {sender!r}, message dropped.")
+                return
 
-                    # decrypt the json content using utf-8 and json.load
-                    decrypted_json_str = decrypted_content_bytes.decode("utf-8")
-                    message_payload = json.loads(decrypted_json_str)
+            sender = sys.intern(sender)
 
-                    # Check for replay attacks. If the nonce has been seen before, let the user know
-                    replay_nonce = message_payload.get("nonce")
-                    if replay_nonce in self.seen_nonces:
-                        logger.warning(
-                            f"SECURITY WARNING: Replay attack detected! Dropping packet {replay_nonce}"
-                        )
-                        continue
+            # Decode from base64, the message itself arrives as raw bytes
+            iv = b64decode(iv_b64)
+            signature = b64decode(signature_b64)
 
-                    # If we get here, the message is unique and not been replayed, so add it to the set
-                    self.seen_nonces.append(replay_nonce)
+            # The sender reuses its session key, so the rsa decrypt is
+            # only needed the first time we see a wrapped key from them
+            session = self.peer_session_keys.get(sender)
+            if session is not None and session[0] == encrypted_key_b64:
+                aesgcm = session[1]
+            else:
+                # Decrypt the aes key with the private rsa key
+                aes_key = self.private_key.decrypt(
+                    b64decode(encrypted_key_b64), OAEP_PADDING
+                )
+                aesgcm = AESGCM(aes_key)
+                session = None
 
-                    # Send to tui
-                    await self.event_queue.put(("message", message_payload))
+            # unwrap the message key with the session key, the first
+            # 12 bytes of the envelope are the IV it was wrapped with
+            wrapped_key = b64decode(wrapped_key_b64)
+            message_key = aesgcm.decrypt(wrapped_key[:12], wrapped_key[12:], None)
 
-                # Skip invalid messages
-                except Exception as e:
-                    error_message = f"Error decrypting message {e}"
-                    await self.event_queue.put(("message", error_message))
-                    logger.error(f"Error decrypting message: {e}")
-                    continue
+            # decrypt the content via aes
+            decrypted_content_bytes = AESGCM(message_key).decrypt(
+                iv, encrypted_message, None
+            )
 
-            # --- JOIN PACKET ---
-            elif packet_type == "J":
-                # Extract the new nickname and key from the packet
-                new_nick, new_key = packet.get("n"), packet.get("k")
+            # Create local hash of the content to compare against the hash received
+            digest = hashes.Hash(SHA256, backend=default_backend())
+            digest.update(decrypted_content_bytes)
+            payload_hash = digest.finalize()
 
-                if new_nick and new_key:
-                    self.store_user_public_key(new_nick, new_key)
+            # Get senders public key to use to verify the signature
+            sender_public_key = self.user_public_keys.get(sender)
 
-                    # update the tui with the name of the new user
-                    await self.event_queue.put(
-                        ("join_packet", f"{new_nick} has joined the chat!")
-                    )
+            if not sender_public_key:
+                logger.error(f"No public key for {sender}")
+                return
 
-            # --- DIR PACKET ---
-            elif packet_type == "DIR":
-                connected_users_list = packet.get("p", [])
+            try:
+                sender_public_key.verify(
+                    signature,
+                    payload_hash,
+                    PSS_PADDING,
+                    SHA256,
+                )
+            except Exception as e:
+                logger.error(
+                    f"SECURITY: Invalid signature from {sender}. Message rejected. {e}"
+                )
+                return
 
-                for user_data in connected_users_list:
-                    nick, key = user_data.get("n"), user_data.get("k")
+            # Only keep the session key once the sender's signature checks out
+            if session is None:
+                self.peer_session_keys[sender] = (encrypted_key_b64, aesgcm)
 
-                    if nick and key:
-                        self.store_user_public_key(nick, key)
+            # parse the decrypted json content straight from the bytes
+            message_payload = json_loads(decrypted_content_bytes)
 
-                await self.event_queue.put(
-                    (
-                        "dir",
-                        f"Connected. Found {len(connected_users_list)} users in the chat.",
-                    )
+            # Check for replay attacks. If the nonce has been seen before, let the user know
+            replay_nonce = message_payload.get("nonce")
+            if replay_nonce in self.seen_nonces:
+                logger.warning(
+                    f"SECURITY WARNING: Replay attack detected! Dropping packet {replay_nonce}"
                 )
+                return
 
-            # --- LEAVE PACKET ---
-            elif packet_type == "L":
-                # assign nickname of user who is leaving to a variable
-                left_nick = packet.get("n")
+            # If we get here, the message is unique and not been replayed, so add it to the set
+            self.seen_nonces.append(replay_nonce)
 
-                # if that user is inside the public keys dict, delete them from it
-                if left_nick in self.user_public_keys:
-                    del self.user_public_keys[left_nick]
+            # Send to tui
+            await self.event_queue.put(("message", message_payload))
 
-                    # update the tui
-                    await self.event_queue.put(
-                        ("leave_packet", f"{left_nick} has left the chat")
-                    )
+        # Skip invalid messages
+        except Exception as e:
+            error_message = f"Error decrypting message {e}"
+            await self.event_queue.put(("message", error_message))
+            logger.error(f"Error decrypting message: {e}")
+            return
 
-            # --- ERROR PACKET ---
-            elif packet_type == "ERR":
-                error_message = packet.get("c")
+    # --- JOIN PACKET ---
+    async def _handle_join(self, packet: dict[str, Any]) -> None:
+        # Extract the new nickname and key from the packet
+        new_nick, new_key = packet.get("n"), packet.get("k")
 
-                # update the tui
-                await self.event_queue.put(("err", error_message))
+        if new_nick and new_key:
+            self.store_user_public_key(new_nick, new_key)
 
-    async def send_message(self, content: str):
+            # update the tui with the name of the new user
+            await self.event_queue.put(
+                ("join_packet", f"{new_nick} has joined the chat!")
+            )
+
+    # --- DIR PACKET ---
+    async def _handle_dir(self, packet: dict[str, Any]) -> None:
+        connected_users_list = packet.get("p", [])
+
+        for user_data in connected_users_list:
+            nick, key = user_data.get("n"), user_data.get("k")
+
+            if nick and key:
+                self.store_user_public_key(nick, key)
+
+        await self.event_queue.put(
+            (
+                "dir",
+                f"Connected. Found {len(connected_users_list)} users in the chat.",
+            )
+        )
+
+    # --- LEAVE PACKET ---
+    async def _handle_leave(self, packet: dict[str, Any]) -> None:
+        # assign nickname of user who is leaving to a variable
+        left_nick = packet.get("n")
+
+        # if that user is inside the public keys dict, delete them from it
+        if left_nick in self.user_public_keys:
+            del self.user_public_keys[left_nick]
+            self.fingerprints.pop(left_nick, None)
+            self.session_keys.pop(left_nick, None)
+            self.peer_session_keys.pop(left_nick, None)
+
+            # update the tui
+            await self.event_queue.put(
+                ("leave_packet", f"{left_nick} has left the chat")
+            )
+
+    # --- ERROR PACKET ---
+    async def _handle_error(self, packet: dict[str, Any]) -> None:
+        error_message = packet.get("c")
+
+        # update the tui
+        await self.event_queue.put(("err", error_message))
+
+    async def send_message(self, content: str, flush: bool = True):
         """
-        Collect input from the user. Checks if the message is intended for a specific person, if not, broadcast to all. Remove whitespace at the start and end of each message. Encrypt the message with AES, then encrypt the AES key with RSA public key. Build the message packet, and send via the _send_packet helper method. bosh.
+        Collect input from the user. Checks if the message is intended for a specific person, if not, broadcast to all. Remove whitespace at the start and end of each message. Encrypt the message with AES, then encrypt the AES key with RSA public key. Build the message packet, and send it with flush(). bosh.
+
+        With flush=False the packets are held back until flush() is called, so
+        several messages can go out in a single write.
         """
 
-        # Packet structure for reference;
+        # Packet structure for reference. The body is encrypted once, and each
+        # recipient gets an envelope to unlock it with;
         # {
         #   "t": "M",              // Type: Message
-        #   "r": "Bob",            // Recipient: "Nickname" or "ALL"
-        #   "s": "Alice",          // Sender (Added by Server)
+        #   "e": {                 // Envelopes: Recipient nickname -> [k, w]
+        #     "Bob": ["...", "..."]  // k: Our session key with Bob, encrypted with Bob's RSA Public Key (Base64 String)
+        #   },                       // w: Wrap IV + the message key, encrypted with that session key (Base64 String)
         #   "iv": "...",           // AES Initialization Vector (Base64 String)
-        #   "k": "...",            // The AES Key, encrypted with Recipient's RSA Public Key (Base64 String)
-        #   "m": "..."             // The Message Content (sender, message content, nonce), encrypted with the AES Key (Base64 String)
+        #   "m": "..."             // The Message Content (sender, message content, nonce), encrypted with the message key (raw bytes after the JSON header)
         #   "h": "..."             // Message digest, to protect against tampering whilst in transit
         # }
-
-        # if the user enters quit or exit, stop the program
-        if content.strip().lower() in ["exit", "quit", ":q"]:
-            sys.exit(0)
+        # The server splits the envelopes out, so Bob receives
+        # {"t": "M", "s": "Alice", "iv": ..., "m": ..., "h": ..., "k": ..., "w": ...}
 
         # Assume that the message is being sent to everyone initially
         recipient = "ALL"
@@ -589,32 +810,15 @@ class Client:
         payload_bytes = payload_packet.encode("utf-8")
 
         # SHA256 hash of the base64 string, to be added to the packet for verification
-        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+        digest = hashes.Hash(SHA256, backend=default_backend())
         digest.update(payload_bytes)
         payload_hash = digest.finalize()
 
         # Signature created with senders private key
-        signature = self.private_key.sign(
-            payload_hash,
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256(),
-        )
-
-        # Generate AES and IV for encryption
-        aes_key = AESGCM.generate_key(bit_length=AES_KEY_SIZE)
-        aesgcm = AESGCM(aes_key)
-        iv_nonce = os.urandom(12)
-
-        encrypted_content_bytes = aesgcm.encrypt(iv_nonce, payload_bytes, None)
+        signature = self.private_key.sign(payload_hash, PSS_PADDING, SHA256)
 
         # Convert back to string for the packet
-        b64_iv = base64.b64encode(iv_nonce).decode("utf-8").replace("\n", "")
-        b64_content = (
-            base64.b64encode(encrypted_content_bytes).decode("utf-8").replace("\n", "")
-        )
-        b64_signature = base64.b64encode(signature).decode("utf-8").replace("\n", "")
+        b64_signature = b64encode(signature)
 
         # Create empty targets list to populate with recipients
         targets = []
@@ -637,45 +841,102 @@ class Client:
             await self.event_queue.put(("no_targets", "No other users connected."))
             return
 
-        # NOTE: Optimization needed. Currently, we encrypt and upload the full message body N times for N users. A better approach would be to encrypt the body once (AES), and only encrypt the AES key N times (RSA), sending a single payload to the server.
+        # Start a session with anyone we haven't messaged yet. The rsa wraps
+        # run in threads side by side, cryptography releases the GIL for them
+        # Take each key now, the peer may leave or rejoin with a new one
+        # while the threads run
+        new_peers = {
+            nick: self.user_public_keys[nick]
+            for nick in targets
+            if nick not in self.session_keys
+        }
+        if new_peers:
+            sessions = await asyncio.gather(
+                *(asyncio.to_thread(self._new_session, key) for key in new_peers.values()),
+                return_exceptions=True,
+            )
+            for (nick, key), session in zip(new_peers.items(), sessions):
+                if isinstance(session, Exception):
+                    logger.error(f"Failed to start a session with {nick}: {session}")
+                # A session wrapped for a key they no longer have is no use
+                elif self.user_public_keys.get(nick) is key:
+                    self.session_keys[nick] = session
+
+        # Encrypt the body once, under a key used for this message only
+        message_key = AESGCM.generate_key(bit_length=AES_KEY_SIZE)
+        iv_nonce = os.urandom(12)
+        encrypted_content_bytes = AESGCM(message_key).encrypt(
+            iv_nonce, payload_bytes, None
+        )
 
         # For all of the nickname(s) in targets.
-        # - Get their public RSA key
-        # - Encrypt the AES key with the users RSA key
+        # - Get the AES session key we share with them
+        # - Wrap the message key with it under a fresh IV
+        envelopes = {}
         for target_nick in targets:
             try:
-                # Get the user(s) public rsa key
-                target_pub_key = self.user_public_keys[target_nick]
-
-                # Encrypt AES Key with users RSA Key
-                encrypted_aes_key = target_pub_key.encrypt(
-                    aes_key,
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None,
-                    ),
-                )
+                session = self.session_keys.get(target_nick)
+                if session is None:
+                    continue
 
-                # The encrypted aes key, courtesy of rsa. Wicked.
-                b64_encrypted_key = base64.b64encode(encrypted_aes_key).decode("utf-8")
+                session_encrypt, b64_encrypted_key = session
 
-                # Build Packet
-                message_packet = {
-                    "t": "M",
-                    "r": target_nick,  # Routing: Individual Nickname
-                    # "s": ... server adds this
-                    "iv": b64_iv,  # AES Setup
-                    "k": b64_encrypted_key,  # The key to the door
-                    "m": b64_content,  # The message
-                    "h": b64_signature,
-                }
+                # The session key is reused, so every wrap needs its own random IV
+                wrap_iv = os.urandom(12)
+                wrapped_key = session_encrypt(wrap_iv, message_key, None)
 
-                await self._send_packet(message_packet)
+                # The key to the door, and the key to the message behind it
+                envelopes[target_nick] = [b64_encrypted_key, b64encode(wrap_iv + wrapped_key)]
 
             except Exception as e:
                 logger.error(f"Failed to send to {target_nick}: {e}")
 
+        # One packet for everyone, the ciphertext goes up to the server once.
+        # Unless there are so many envelopes the frame would pass
+        # MAX_PACKET_LENGTH, then it's split, each part repeating iv/h/payload.
+        header = {
+            "t": "M",
+            "e": {},
+            # "s": ... server adds this
+            "iv": b64encode(iv_nonce),  # AES Setup
+            "h": b64_signature,
+        }
+        base_size = (
+            FRAME_HEADER.size
+            + JSON_LENGTH.size
+            + len(json_dumps(header))
+            + len(encrypted_content_bytes)
+        )
+        if envelopes and base_size >= MAX_PACKET_LENGTH:
+            await self.event_queue.put(("err", "Message too large to send."))
+            return
+
+        size = base_size
+        for target_nick, envelope in envelopes.items():
+            # "nick":["k","w"], the nick measured as JSON so any escaping
+            # counts, plus the separators around it
+            envelope_size = (
+                len(json_dumps(target_nick)) + len(envelope[0]) + len(envelope[1]) + 10
+            )
+            if header["e"] and size + envelope_size > MAX_PACKET_LENGTH:
+                self._pending_packets.append(
+                    # The message, sent raw after the JSON header
+                    encode_packet(header, payload=encrypted_content_bytes)
+                )
+                header = {**header, "e": {}}
+                size = base_size
+
+            header["e"][target_nick] = envelope
+            size += envelope_size
+
+        if header["e"]:
+            self._pending_packets.append(
+                encode_packet(header, payload=encrypted_content_bytes)
+            )
+
+        if flush:
+            await self.flush()
+
         await self.event_queue.put(
             ("my_message", {"sender": "Me: ", "content": content})
         )
@@ -687,10 +948,46 @@ class Client:
         else:
             await self.event_queue.put(("sent_to_user", f"DM sent to {recipient}"))
 
+    async def flush(self):
+        """Send every packet held back by send_message(flush=False)"""
+        frames, self._pending_packets = self._pending_packets, []
+        if not frames:
+            return
+
+        if self.writer is None:
+            logger.error("No connection.")
+            return
+
+        try:
+            self.writer.writelines(frames)
+            await self.writer.drain()
+
+        except Exception as e:
+            logger.warning(f"Error sending packet: {e}")
+
+    def _new_session(self, public_key: RSAPublicKey) -> tuple[Callable[..., bytes], str]:
+        """
+        Generate a session AES key for a user and wrap it with their RSA key.
+        Only touches the key it is given, so it is safe to run in a thread.
+        """
+        aes_key = AESGCM.generate_key(bit_length=AES_KEY_SIZE)
+
+        # Encrypt AES Key with users RSA Key, once per session
+        encrypted_aes_key = public_key.encrypt(aes_key, OAEP_PADDING)
+
+        # The encrypted aes key, courtesy of rsa. Wicked.
+        # Only encrypt is ever called on the session, so hand back the bound
+        # method and save the attribute lookup on every message
+        return (
+            AESGCM(aes_key).encrypt,
+            b64encode(encrypted_aes_key),
+        )
+
     # Generates a list of connected users
     async def display_connected_users(self):
-        # Go through every username in user_public_keys
-        return set(self.user_public_keys.keys())
+        # Live view of the usernames in user_public_keys, nicknames are already
+        # unique dict keys so there is nothing to dedupe or copy
+        return self.user_public_keys.keys()
 
     async def _cleanup(self) -> None:
         """
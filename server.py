@@ -1,13 +1,32 @@
-import argparse
 import asyncio
+import itertools
 import json
 import logging
-import random
-from datetime import datetime
+import re
+import socket
+import struct
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
 
-import uvicorn
 from cryptography.hazmat.primitives import serialization
-from fastapi import FastAPI, WebSocket
+
+# orjson is optional, it's a faster drop-in for the json on the packet path.
+# Both versions dump straight to bytes and load from bytes or str.
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+
+    def json_dumps(obj: object) -> bytes:
+        # Compact and unescaped, the same bytes orjson would produce
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode(
+            "utf-8"
+        )
+
+    json_loads = json.loads
 
 # Logger setup
 logger = logging.getLogger(__name__)
@@ -15,12 +34,60 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-app = FastAPI()
-
 # Constants
-NICKNAME_SUFFIX_MIN = 100
-NICKNAME_SUFFIX_MAX = 999
 HANDSHAKE_TIMEOUT = 5
+MAX_PACKET_LENGTH = 256 * 1024  # Same limit as the client
+FRAME_HEADER = struct.Struct(">I")  # 4 byte big-endian length in front of every packet
+JSON_LENGTH = struct.Struct(">I")  # Length of the JSON header, the raw payload follows it
+SOCKET_BUFFER_SIZE = 1 << 20  # 1MiB kernel send/receive buffers, same as the client
+MAX_WRITE_BUFFER = 4 * 1024 * 1024  # Unsent bytes a client may fall behind by before it's dropped
+LISTEN_BACKLOG = 4096  # Pending connections the kernel queues, capped by net.core.somaxconn
+MAX_PEM_LENGTH = 4096  # A 2048 bit public key PEM is ~450 bytes
+# Shape of a PEM public key, checked before handing anything to OpenSSL
+PEM_RE = re.compile(
+    r"-----BEGIN PUBLIC KEY-----\n(?:[A-Za-z0-9+/=]{1,76}\n)+-----END PUBLIC KEY-----\n?"
+)
+
+
+def encode_packet(packet: dict, payload: bytes = b"") -> bytes:
+    """Serialize a packet to a frame: [length][json length][json header][payload]"""
+    return encode_frame(json_dumps(packet), payload)
+
+
+def encode_frame(header: bytes, payload: bytes = b"") -> bytes:
+    """Frame an already serialized JSON header, see encode_packet"""
+    return (
+        FRAME_HEADER.pack(JSON_LENGTH.size + len(header) + len(payload))
+        + JSON_LENGTH.pack(len(header))
+        + header
+        + payload
+    )
+
+
+@lru_cache(maxsize=1024)
+def _validate_pem(pem: str) -> bool:
+    """
+    Check that a PEM string holds a valid public key. Parsing is slow, so the
+    result is cached by PEM and reconnecting users don't pay for it again.
+    """
+    try:
+        # If this passes, the key is mathematically valid
+        serialization.load_pem_public_key(pem.encode("utf-8"))
+        return True
+
+    # If it does not pass, ValueError is raised, indicating that the public key is invalid.
+    except Exception as e:
+        logger.error(f"Error (likely an invalid public key): {e}")
+        return False
+
+
+@dataclass(slots=True)
+class ClientState:
+    """A connected user's writer and public key, one per connected_users entry"""
+
+    writer: asyncio.StreamWriter
+    key: str  # PEM encoded public key
+    dir_entry: bytes  # {"n": nickname, "k": key} as JSON, reused in every DIR packet
 
 
 class BeatriceServer:
@@ -30,19 +97,26 @@ class BeatriceServer:
 
         # Data Structure Reference:
         # self.connected_users = {
-        #    "Alice": {
-        #        "writer": <asyncio.StreamWriter>,
-        #        "key": "-----BEGIN PUBLIC KEY..."
-        #    },
-        #    "Jordan": {
-        #        "writer": <asyncio.StreamWriter>,
-        #        "key": "-----BEGIN PUBLIC KEY..."
-        #    },
+        #    "Alice": ClientState(
+        #        writer=<asyncio.StreamWriter>,
+        #        key="-----BEGIN PUBLIC KEY...",
+        #        dir_entry=b'{"n":"Alice","k":"-----BEGIN PUBLIC KEY..."}'
+        #    ),
+        #    "Jordan": ClientState(
+        #        writer=<asyncio.StreamWriter>,
+        #        key="-----BEGIN PUBLIC KEY...",
+        #        dir_entry=b'{"n":"Jordan","k":"-----BEGIN PUBLIC KEY..."}'
+        #    ),
         # }
-        self.connected_users = {}
+        self.connected_users: dict[str, ClientState] = {}
 
         self._users_lock = asyncio.Lock()
 
+        # Base nickname -> counter handing out the "#n" suffixes for duplicates
+        self._nickname_suffixes: defaultdict[str, itertools.count] = defaultdict(
+            lambda: itertools.count(1)
+        )
+
     async def start_server(self):
 
         server = await asyncio.start_server(
@@ -50,7 +124,8 @@ class BeatriceServer:
             self.host,
             self.port,
             reuse_address=True,
-            # limit=256 * 1024,
+            limit=MAX_PACKET_LENGTH,
+            backlog=LISTEN_BACKLOG,
         )
 
         async with server:
@@ -60,6 +135,16 @@ class BeatriceServer:
         """
         This will handle most of the server side logic and make sure everything is called in the right order.
         """
+        # Small interactive packets, so no Nagle delay, and room in the kernel
+        # buffers for the fan out of broadcasts to this client. Keepalive lets
+        # the kernel notice peers that vanished without closing the connection.
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+
         # 1. Perform handshake
         nickname = await self._handshake(reader, writer)
         if not nickname:
@@ -69,7 +154,7 @@ class BeatriceServer:
 
         try:
             # 2. Synchronise
-            key = self.connected_users[nickname]["key"]
+            key = self.connected_users[nickname].key
             await self._synchronise(writer, nickname, key)
 
             # 3. Init message loop
@@ -85,35 +170,73 @@ class BeatriceServer:
     async def _receive_packet(self, reader) -> None | dict[str, str]:
         """Method that listens for packets and correctly stops the server if the client leaves"""
         try:
-            message: bytes = await reader.readline()
+            # Read the length header, then exactly one packet's worth of bytes
+            header = await reader.readexactly(FRAME_HEADER.size)
+            (length,) = FRAME_HEADER.unpack(header)
+            if length > MAX_PACKET_LENGTH:
+                raise ConnectionResetError("Packet too large")
+            message: bytes = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            # EOF received. Raise exception to break the loop in the caller.
+            raise ConnectionResetError("Client disconnected")
         except Exception as e:
             logger.error(f"Socket read error: {e}")
             raise e  # Re-raise so the loop knows to stop
 
-        if message == b"":
-            # EOF received. Raise exception to break the loop in the caller.
-            raise ConnectionResetError("Client disconnected")
-
-        if message == b"\n":
-            await asyncio.sleep(0.1)
-            return None
-
         try:
-            packet = json.loads(message.decode("utf-8"))
+            # Frame is [json length][json header][payload], the payload is the
+            # raw ciphertext of a message and is passed through untouched
+            (header_length,) = JSON_LENGTH.unpack_from(message)
+            end = JSON_LENGTH.size + header_length
+            packet = json_loads(message[JSON_LENGTH.size : end])
+            if end < len(message):
+                packet["m"] = memoryview(message)[end:]
             return packet
-        except json.JSONDecodeError as e:
+        except (json.JSONDecodeError, struct.error) as e:
             logger.error(f"Invalid JSON {e}")
             return None
 
-    async def _send_packet(self, writer, packet):
+    async def _send_packet(self, writer, packet, payload=b""):
+        """
+        1. Encodes the packet to JSON bytes, prefixed with its length, with the raw payload after it.
+        2. Writes it to the specific writer via _send_frame.
+        """
+        await self._send_frame(writer, encode_packet(packet, payload))
+
+    def _write_frame(self, writer, frame):
         """
-        1. Encodes the packet to JSON bytes (with newline).
-        2. Writes it to the specific writer.
-        3. Drains the writer to ensure it sent.
+        Like _send_frame, but without the drain. Used for fan outs, where
+        awaiting each recipient's drain would only add an event loop round
+        trip per recipient; the transport buffers the frame and sends it
+        as soon as the socket is writable.
+        """
+        if writer.is_closing():
+            return
+
+        try:
+            writer.write(frame)
+
+            # Nothing waits on the drain here, so a client that stops reading
+            # would buffer without limit. Drop it instead; abort rather than
+            # close, as close would wait for the buffer it will never read.
+            # Its handle_client then sees the connection go and runs _cleanup.
+            if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                logger.warning("Dropping a client that stopped reading")
+                writer.transport.abort()
+
+        # If writing fails, the socket is likely closed
+        except Exception as e:
+            logger.error(f"Error: {e}")
+
+    async def _send_frame(self, writer, frame):
+        """
+        1. Writes an already encoded frame to the specific writer.
+        2. Drains the writer to ensure it sent.
+        Broadcasts encode their packet once and send the same frame to everyone.
         Safety: Wrap in try/except to ignore broken pipes.
         """
         try:
-            writer.write((json.dumps(packet) + "\n").encode("utf-8"))
+            writer.write(frame)
             await writer.drain()
 
         # If sending fails, the socket is likely closed
@@ -134,17 +257,22 @@ class BeatriceServer:
 
         Success: Only then do you look at the nickname and let them in.
         """
+        # One deadline for the whole handshake, so skipping bad packets
+        # can't stretch it out
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + HANDSHAKE_TIMEOUT
+
         while True:
             try:
                 packet = await asyncio.wait_for(
-                    self._receive_packet(reader), timeout=HANDSHAKE_TIMEOUT
+                    self._receive_packet(reader), timeout=deadline - loop.time()
                 )
             except asyncio.TimeoutError:
                 logger.warning("Handshake timed out")
                 return None
 
+            # readexactly already waits for the next packet, no need to sleep
             if packet is None:
-                await asyncio.sleep(0.1)
                 continue
 
             elif packet.get("t") == "H":
@@ -165,43 +293,44 @@ class BeatriceServer:
                     await self._send_packet(writer, err_packet)
                     return None
 
+                # Every other client uses the nickname as a dict key and interns it
+                if not isinstance(_nickname, str):
+                    error_msg = "Invalid nickname."
+                    err_packet = {"t": "ERR", "c": error_msg}
+                    await self._send_packet(writer, err_packet)
+                    return None
+
                 # Check that the data packet contains the key information.
-                if not _key or not _key.startswith("-----BEGIN PUBLIC KEY"):
+                # Obvious garbage is turned away before it reaches the parser.
+                if (
+                    not isinstance(_key, str)
+                    or len(_key) > MAX_PEM_LENGTH
+                    or not PEM_RE.fullmatch(_key)
+                ):
                     error_msg = "Invalid public key."
                     err_packet = {"t": "ERR", "c": error_msg}
                     await self._send_packet(writer, err_packet)
                     return None
 
-                loop = asyncio.get_running_loop()
-                try:
-                    # If this passes, the key is mathematically valid
-                    await loop.run_in_executor(
-                        None,
-                        serialization.load_pem_public_key,
-                        _key.encode("utf-8"),
-                    )
-
-                # If it does not pass, ValueError is raised, indicating that the public key is invalid.
-                except Exception as e:
+                if not await loop.run_in_executor(None, _validate_pem, _key):
                     error_msg = "Invalid public key. Invalid format or encoding. Please provide a valid PEM-encoded public key."
                     await self._send_packet(writer, {"t": "ERR", "c": error_msg})
-                    logger.error(f"Error (likely an invalid public key): {e}")
                     return None
 
                 try:
                     # Check to make sure this is a nickname that isn't already in use. If it is, append a number and generate another one until you find a non-used name.
+                    # Suffixes come from a counter per base name, so each one is
+                    # new, and the check and the insert both happen under the lock.
                     final_nickname = _nickname
-                    if _nickname in self.connected_users:
-                        suffix = random.randint(
-                            NICKNAME_SUFFIX_MIN, NICKNAME_SUFFIX_MAX
-                        )
-                        final_nickname = f"{_nickname}#{suffix}"
                     async with self._users_lock:
-                        self.connected_users[final_nickname] = (
-                            {  # Store this in the connected_users dict
-                                "writer": writer,
-                                "key": _key,
-                            }
+                        while final_nickname in self.connected_users:
+                            suffix = next(self._nickname_suffixes[_nickname])
+                            final_nickname = f"{_nickname}#{suffix}"
+                        # Store this in the connected_users dict
+                        self.connected_users[final_nickname] = ClientState(
+                            writer=writer,
+                            key=_key,
+                            dir_entry=json_dumps({"n": final_nickname, "k": _key}),
                         )
                     self.latest_nickname = final_nickname
                     return final_nickname
@@ -229,7 +358,8 @@ class BeatriceServer:
             "k": new_key,
         }
 
-        # Create full list of current connected users
+        # Create full list of current connected users. Each user's entry was
+        # serialized when they joined, so it's only joined together here
         targets = []
         current_user_list = []
 
@@ -237,8 +367,8 @@ class BeatriceServer:
             for user, data in self.connected_users.items():
                 # send the dir_packet to the new user
                 if user != new_nickname:
-                    current_user_list.append({"n": user, "k": data["key"]})
-                    targets.append(data["writer"])
+                    current_user_list.append(data.dir_entry)
+                    targets.append(data.writer)
 
         # dir_packet structure for reference
         # {
@@ -255,34 +385,34 @@ class BeatriceServer:
         #   ]
         # }
 
-        dir_packet = {
-            "t": "DIR",
-            "p": current_user_list,
-        }
+        dir_header = b'{"t":"DIR","p":[' + b",".join(current_user_list) + b"]}"
         # send the packet to the new user
-        await self._send_packet(writer, dir_packet)
+        await self._send_frame(writer, encode_frame(dir_header))
 
         # Info on the recently joined person, to be sent to everyone else. Bosh
-
-        tasks = [self._send_packet(t_writer, join_packet) for t_writer in targets]
-
-        await asyncio.gather(*tasks, return_exceptions=True)
+        # Everyone gets the same bytes, so encode it once
+        join_frame = encode_packet(join_packet)
+        for t_writer in targets:
+            self._write_frame(t_writer, join_frame)
 
     async def _message_loop(self, reader, nickname):
         """
         This is an infinite loop which will continuously listen for messages and dispatch messages to the intended recipient(s).
 
-        Make sure that a delimiter is used so the whole message is read properly asyncio.StreamReader()
+        Packets are length-prefixed, so each read returns exactly one whole message.
 
         Handle Disconnection: If a client disconnects, make sure to remove them from connected_users list.
 
         {
             "t": "M",          # Type: Message
-            "r": "recipient",  # Who is it for? (e.g., "Bob" or "ALL")
-            "m": "..."         # The Message Content (Encrypted String)
+            "e": {"Bob": [k, w]},  # Envelopes, the keys each recipient needs
+            "m": b"..."        # The Message Content (raw bytes after the JSON header), shared by everyone
             "s": "sender"      # The sender of the message
         }
 
+        Each recipient is sent the packet without "e", with their own envelope
+        as "k" and "w" instead.
+
         """
         while True:  # continuously listen for incoming messages
             try:
@@ -294,29 +424,40 @@ class BeatriceServer:
                 continue
 
             elif message_packet.get("t") == "M":
-                # Get recipient data
-                recipient = message_packet.get("r")
+                # The body is shared, split the envelopes out so every recipient
+                # gets the ciphertext plus only their own keys
+                envelopes = message_packet.pop("e", None)
+                if not isinstance(envelopes, dict):
+                    continue
                 message_packet["s"] = nickname
+                payload = message_packet.pop("m", b"")
 
-                target_writer = None
+                missing = []
 
                 async with self._users_lock:
-                    if recipient in self.connected_users:
-                        # Copy reference to the writer
-                        target_writer = self.connected_users[recipient]["writer"]
-
-                # If the writer is found, send the message packet to it
-                if target_writer:
-                    try:
-                        await self._send_packet(
-                            self.connected_users[recipient].get("writer"),
-                            message_packet,
+                    for recipient, envelope in envelopes.items():
+                        user = self.connected_users.get(recipient)
+                        if user is None:
+                            missing.append(recipient)
+                            continue
+
+                        try:
+                            key, wrapped_key = envelope
+                        except (TypeError, ValueError):
+                            continue
+
+                        # Hand the frame to the recipient's transport, no
+                        # per-recipient drain so the fan out never yields
+                        self._write_frame(
+                            user.writer,
+                            encode_packet(
+                                {**message_packet, "k": key, "w": wrapped_key},
+                                payload,
+                            ),
                         )
-                    except Exception as e:
-                        logger.error(f"Error target writer not found: {e}")
-                        return
-                else:
-                    # Send error packet if the writer is not found
+
+                # Send error packet if the writer is not found
+                for recipient in missing:
                     error_packet = {
                         "t": "ERR",
                         "c": f"User '{recipient}' not found.",
@@ -336,20 +477,20 @@ class BeatriceServer:
         should also close the server if no connections are active
         """
 
+        # Remove user from the connected_user list, one lookup for both the
+        # check and the removal
+        async with self._users_lock:
+            user = self.connected_users.pop(nickname, None)
+
         # Handles an edge case that if the user is not already in the connected_users list, we dont need to do anything
-        if nickname not in self.connected_users:
+        if user is None:
             return
 
         logger.info(f"{nickname} disconnecting...")
+        logger.info(f"----- Server: {nickname} has disconnected -----")
 
         # Get the writer of the user we need to remove
-        writer_to_close = self.connected_users[nickname]["writer"]
-
-        # Remove user from the connected_user list
-        async with self._users_lock:
-            del self.connected_users[nickname]
-            logger.info(f"----- Server: {nickname} has disconnected -----")
-            # print(f"----- Server: {nickname} has disconnected -----")
+        writer_to_close = user.writer
 
         # Notify other users by sending the leave packet
         # Leave packet structure for reference
@@ -359,16 +500,12 @@ class BeatriceServer:
         # }
         leave_packet = {"t": "L", "n": nickname}  # Type: Leave  # Who is leaving
 
-        # TODO: write better algo to send this faster than O(1) - not sure its possible
-        # Iterate through the connected user list and send them the leave packet
+        # Encode the leave packet once, then hand it to everyone's transport
+        # so one slow client doesn't hold up the rest
+        leave_frame = encode_packet(leave_packet)
         async with self._users_lock:
-            for user in self.connected_users.keys():
-                target_writer = self.connected_users[user]["writer"]
-                try:
-                    await self._send_packet(target_writer, leave_packet)
-                except Exception as e:
-                    logger.error(f"Error: {e}")
-                    pass
+            for data in self.connected_users.values():
+                self._write_frame(data.writer, leave_frame)
 
         # Close the socket of the disconnected user
         try:
@@ -385,7 +522,8 @@ class BeatriceServer:
 
 
 # --- Execution ---
-if __name__ == "__main__":
+def _parse_args():
+    import argparse
 
     parser = argparse.ArgumentParser(
         prog="Beatrice Server",
@@ -414,12 +552,28 @@ if __name__ == "__main__":
         help="Show this help message",
     )
 
-    args = parser.parse_args()
+    return parser.parse_args()
+
+
+def main(host: str = "0.0.0.0", port: int = 55556) -> None:
+    """Run a BeatriceServer on host:port until interrupted"""
+    # uvloop is optional, without it the server runs on the default asyncio loop
+    try:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
     # Run the main async entry point
     try:
-        # asyncio.run(server.start_server(args.host, args.port))
-        uvicorn.run(app, host=args.host, port=args.port)
+        server = BeatriceServer(host, port)
+        asyncio.run(server.start_server())
     except KeyboardInterrupt:
         logger.info("Server stopped.")
         print("Server stopped.")
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    main(args.host, args.port)